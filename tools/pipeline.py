@@ -0,0 +1,474 @@
+"""
+Content-addressed cache for the intermediate files of the simulation pipeline.
+
+Each stage is keyed by a hash of its name, the code of the modules it runs, the contents of its input files (and of
+the files they refer to, e.g. the references of a species list) and its parameters (including seeds). Its outputs are stored in <cache>/objects/<key>/ together with a manifest.json, so a stage
+whose key is already in the cache is skipped and a change upstream gives new keys to everything downstream.
+Old artifacts are evicted, least recently used first, when the cache grows beyond its quota, except those
+linked to a user chosen path (out=...) while the link exists.
+
+The cache lives in $NAS_CACHE_DIR (default $TMPDIR/cache) and its quota is $NAS_CACHE_QUOTA GB (default 100).
+"""
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from time import time
+
+from utils import info
+
+HASH_BLOCK_SIZE = 1 << 24
+DEFAULT_QUOTA_GB = 100
+
+
+def write_json(path: str, obj):
+    """Write a json file atomically"""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+class ArtifactCache:
+    def __init__(self, root: str = None, quota: float = None):
+        """
+        :param root: the cache directory. Defaults to $NAS_CACHE_DIR or $TMPDIR/cache
+        :param quota: maximum size of the cache in GB. Defaults to $NAS_CACHE_QUOTA or 100
+        """
+        if root is None:
+            root = os.environ.get('NAS_CACHE_DIR', os.path.join(os.environ.get('TMPDIR', '/tmp'), 'cache'))
+        if quota is None:
+            quota = float(os.environ.get('NAS_CACHE_QUOTA', DEFAULT_QUOTA_GB))
+        self.root = os.path.abspath(root)
+        self.quota = int(quota * (1 << 30))
+        self.objects = os.path.join(self.root, 'objects')
+        self.staging = os.path.join(self.root, 'staging')
+        self.digests_path = os.path.join(self.root, 'digests.json')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.staging, exist_ok=True)
+
+        self.digests = {}
+        if os.path.exists(self.digests_path):
+            with open(self.digests_path) as f:
+                self.digests = json.load(f)
+
+    def file_digest(self, path: str) -> str:
+        """
+        Digest of a file's content. Files produced by a cached stage are identified by the stage key and
+        their name, other files are hashed once and the digest is reused until their size or mtime changes.
+        Only the file itself is hashed; files it refers to are passed to run() as references.
+        :param path: path to the file
+        :return: the digest
+        """
+        path = os.path.realpath(path)
+        if path.startswith(self.objects + os.sep):
+            return 'artifact:' + os.path.relpath(path, self.objects)
+
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        known = self.digests.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+
+        info("Hashing {} ...".format(path))
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                h.update(block)
+        digest = 'sha256:' + h.hexdigest()
+        self.digests[path] = [stamp, digest]
+        write_json(self.digests_path, self.digests)
+        return digest
+
+    def key(self, stage: str, func, inputs: dict, params: dict, modules: tuple = (), references: list = ()) -> str:
+        """
+        Fingerprint of a stage
+        :param stage: the stage name
+        :param func: the function run by the stage. The source of the module defining it is part of the key
+        :param inputs: dict of parameter name to input file path
+        :param params: dict of parameter name to value. Must be json serialisable
+        :param modules: other modules whose code the stage runs. Their source is part of the key
+        :param references: other files read by the stage. Their content is part of the key
+        :return: the key
+        """
+        code = hashlib.sha256()
+        for obj in (inspect.getmodule(func),) + tuple(modules):
+            try:
+                code.update(inspect.getsource(obj).encode())
+            except (OSError, TypeError):
+                # no source available, e.g. functions defined interactively
+                code.update(func.__code__.co_code)
+        fingerprint = {
+            'stage': stage,
+            'code': code.hexdigest(),
+            'inputs': {k: self.file_digest(v) for k, v in inputs.items()},
+            'references': sorted(self.file_digest(path) for path in references),
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:32]
+
+    def artifact_key(self, path: str):
+        """The key of the artifact a file belongs to, or None if it is not in the cache"""
+        path = os.path.realpath(path)
+        if not path.startswith(self.objects + os.sep):
+            return None
+        return os.path.relpath(path, self.objects).split(os.sep)[0]
+
+    def load_manifest(self, key: str, outputs: dict = None):
+        """
+        Load the manifest of an artifact
+        :param key: the artifact key
+        :param outputs: if given, dict of output names to file names that must all exist
+        :return: the manifest, or None if the artifact is missing or incomplete
+        """
+        obj_dir = os.path.join(self.objects, key)
+        try:
+            with open(os.path.join(obj_dir, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if outputs is not None and not all(os.path.exists(os.path.join(obj_dir, v)) for v in outputs.values()):
+            return None
+        return manifest
+
+    def touch(self, key: str, manifest: dict = None):
+        """Mark an artifact as recently used"""
+        if manifest is None:
+            manifest = self.load_manifest(key)
+            if manifest is None:
+                return
+        manifest['last_used'] = time()
+        write_json(os.path.join(self.objects, key, 'manifest.json'), manifest)
+
+    def remove(self, key: str):
+        """Delete an artifact. It is first moved out of objects/ so that it is never seen half deleted"""
+        trash = os.path.join(self.staging, "{}.{}.removed".format(key, os.getpid()))
+        try:
+            os.rename(os.path.join(self.objects, key), trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def run(self, stage: str, func, inputs: dict, params: dict, outputs: dict, settings: dict = None,
+            modules: tuple = (), references: list = (), links: dict = None) -> dict:
+        """
+        Run a stage unless its outputs are already in the cache. The function is called as
+        func(**inputs, **params, **outputs, **settings) with each output name mapped to a path to write.
+        :param stage: the stage name
+        :param func: the function run by the stage
+        :param inputs: dict of parameter name to input file path
+        :param params: dict of parameter name to value; part of the key
+        :param outputs: dict of parameter name to output file name
+        :param settings: dict of parameter name to value that do not change the outputs (e.g. server addresses)
+        :param modules: other modules whose code the stage runs
+        :param references: other files read by the stage, e.g. the files listed in an input
+        :param links: dict of output parameter name to a path to link the output at (see link()). None values are
+            skipped. The paths are checked before the stage is run
+        :return: dict of output parameter name to the cached file path
+        """
+        links = {k: v for k, v in (links or {}).items() if v is not None}
+        for link in links.values():
+            self.check_link(link, inputs.values())
+
+        key = self.key(stage, func, inputs, params, modules, references)
+        obj_dir = os.path.join(self.objects, key)
+        paths = {k: os.path.join(obj_dir, v) for k, v in outputs.items()}
+
+        # upstream artifacts used as inputs are in use too
+        for path in inputs.values():
+            input_key = self.artifact_key(path)
+            if input_key is not None:
+                self.touch(input_key)
+
+        manifest = self.load_manifest(key, outputs)
+        if manifest is not None:
+            self.touch(key, manifest)
+            info("{}: up to date ({})".format(stage, key))
+            return paths
+        if os.path.exists(obj_dir):
+            info("{}: removing incomplete artifact ({})".format(stage, key))
+            self.remove(key)
+
+        info("{}: running ({})".format(stage, key))
+        stage_dir = os.path.join(self.staging, "{}.{}".format(key, os.getpid()))
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        os.makedirs(stage_dir)
+        try:
+            func(**inputs, **params, **{k: os.path.join(stage_dir, v) for k, v in outputs.items()},
+                 **(settings or {}))
+            missing = [v for v in outputs.values() if not os.path.exists(os.path.join(stage_dir, v))]
+            if missing:
+                raise RuntimeError("Stage {} did not write {}".format(stage, ", ".join(missing)))
+        except BaseException:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            raise
+
+        now = time()
+        write_json(os.path.join(stage_dir, 'manifest.json'), {
+            'stage': stage,
+            'key': key,
+            'inputs': {k: [os.path.realpath(v), self.file_digest(v)] for k, v in inputs.items()},
+            'references': {os.path.realpath(path): self.file_digest(path) for path in references},
+            'params': params,
+            'outputs': outputs,
+            'links': [],
+            'size': dir_size(stage_dir),
+            'created': now,
+            'last_used': now,
+        })
+        try:
+            os.rename(stage_dir, obj_dir)
+        except OSError:
+            if self.load_manifest(key, outputs) is not None:
+                # the same stage was completed concurrently
+                shutil.rmtree(stage_dir, ignore_errors=True)
+            else:
+                self.remove(key)
+                os.rename(stage_dir, obj_dir)
+
+        self.evict(keep=(key,))
+        for k, link in links.items():
+            self.link(paths[k], link)
+        return paths
+
+    def check_link(self, link: str, inputs=()):
+        """
+        Check that a link can be made at a path: it must not exist, or be a link into the cache that is not
+        one of the inputs of the stage (replacing it would unpin the input)
+        :param link: the path of the link
+        :param inputs: the input file paths of the stage
+        :return: None
+        """
+        if not os.path.lexists(link):
+            return
+        if not (os.path.islink(link) and os.path.realpath(link).startswith(self.objects + os.sep)):
+            raise ValueError("{} already exists and is not a link into the cache".format(link))
+        if any(os.path.abspath(link) == os.path.abspath(path) or os.path.realpath(link) == os.path.realpath(path)
+               for path in inputs):
+            raise ValueError("{} is an input of the stage and cannot be replaced by its output".format(link))
+
+    def link(self, path: str, link: str):
+        """
+        Make a cached output available at a chosen path by symlinking it. The artifact is pinned, i.e. it is
+        not evicted, as long as the link points to it.
+        :param path: the cached file
+        :param link: the path of the link. Only an existing link into the cache is replaced
+        :return: None
+        """
+        if link is None:
+            return
+        if os.path.lexists(link):
+            self.check_link(link)
+            os.remove(link)
+        os.symlink(path, link)
+        key = self.artifact_key(path)
+        manifest = self.load_manifest(key)
+        links = manifest.setdefault('links', [])
+        if os.path.abspath(link) not in links:
+            links.append(os.path.abspath(link))
+        self.touch(key, manifest)
+        info("{} -> {}".format(link, path))
+
+    def is_pinned(self, manifest: dict) -> bool:
+        """Whether any link made by link() still points into the artifact"""
+        obj_dir = os.path.join(self.objects, manifest['key'])
+        return any(os.path.islink(link) and os.path.realpath(link).startswith(obj_dir + os.sep)
+                   for link in manifest.get('links', []))
+
+    def manifests(self) -> list:
+        result = []
+        for key in os.listdir(self.objects):
+            try:
+                with open(os.path.join(self.objects, key, 'manifest.json')) as f:
+                    result.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return result
+
+    def evict(self, quota: int = None, keep=()):
+        """
+        Delete the least recently used artifacts until the cache fits in the quota. Artifacts linked with
+        link() are kept as long as the links exist.
+        :param quota: the quota in bytes. Defaults to the cache's quota
+        :param keep: keys that must not be evicted
+        :return: the number of artifacts evicted
+        """
+        if quota is None:
+            quota = self.quota
+        manifests = sorted(self.manifests(), key=lambda m: m['last_used'])
+        total = sum(m['size'] for m in manifests)
+        n = 0
+        for m in manifests:
+            if total <= quota:
+                break
+            if m['key'] in keep or self.is_pinned(m):
+                continue
+            info("Evicting {} ({}, {:.2f} GB)".format(m['key'], m['stage'], m['size'] / (1 << 30)))
+            self.remove(m['key'])
+            total -= m['size']
+            n += 1
+        return n
+
+
+def _choose_species(library_report, species_tsv, n_species, library, seed):
+    from utils import load_library_report, choose_species
+
+    df = load_library_report(library_report)
+    choose_species(df, n_species, library=library, seed=seed).to_csv(species_tsv, sep="\t")
+
+
+def _read_species(species_tsv):
+    import pandas as pd
+
+    return pd.read_csv(species_tsv, delimiter="\t", index_col=0, dtype={'taxid': str})
+
+
+def _sample_refs(dfs, n_reads, p, seeds) -> list:
+    from utils import shuffle_ids, sample_refs_for_read
+
+    sids = shuffle_ids(dfs, seed=seeds[0])
+    return sample_refs_for_read(sids, n_reads, p, seed=seeds[1])
+
+
+def _sample_reads(species_tsv, reads_fasta, n_reads, p, seeds):
+    from utils import sample_reads
+
+    dfs = _read_species(species_tsv)
+    read_refs = _sample_refs(dfs, n_reads, p, seeds)
+    sample_reads(dfs, read_refs, reads_fasta, seeds=list(seeds[2:]))
+
+
+def cached_species(n_species: int, seed: int, library: list = None, out: str = None) -> str:
+    """
+    Cached version of choose_species on the KRAKEN library report. The chosen rows are stored as a .tsv
+    :param n_species: number of species to choose
+    :param seed: seed for choosing the species. Required, as an unseeded stage cannot be cached
+    :param library: a list of libraries to choose from (default ['bacteria'])
+    :param out: if given, the output is linked at this path
+    :return: path to the cached .tsv
+    """
+    import utils
+
+    if type(seed) is not int:
+        raise ValueError("seed must be an integer")
+    cache = ArtifactCache()
+    return cache.run(
+        'choose_species', _choose_species,
+        inputs={'library_report': utils.lib_report_path},
+        params={'n_species': n_species, 'library': library or ['bacteria'], 'seed': seed},
+        outputs={'species_tsv': 'species.tsv'},
+        modules=(utils,),
+        links={'species_tsv': out})['species_tsv']
+
+
+def cached_reads(species_tsv: str, n_reads: int, seeds: list, p: float = 0.9, out: str = None) -> str:
+    """
+    Cached version of sampling reads from a set of species (download_ref_files and sample_reads). The
+    references the reads are sampled from are downloaded first, so that their content is part of the key
+    :param species_tsv: the species chosen by cached_species
+    :param n_reads: number of reads to simulate
+    :param seeds: 5 seeds, for shuffling the species, sampling abundances, read lengths, positions and strands.
+        Required, as an unseeded stage cannot be cached
+    :param p: parameter of the log-series distribution of abundances
+    :param out: if given, the output is linked at this path
+    :return: path to the cached .fasta
+    """
+    import numpy as np
+    import utils
+
+    if type(seeds) is not list or len(seeds) != 5 or not all(type(x) is int for x in seeds):
+        raise ValueError("seeds must be a list of 5 integers")
+    dfs = _read_species(species_tsv)
+    refs = dfs.loc[np.unique(_sample_refs(dfs, n_reads, p, seeds))]
+    utils.download_ref_files(refs)
+    cache = ArtifactCache()
+    return cache.run(
+        'sample_reads', _sample_reads,
+        inputs={'species_tsv': species_tsv},
+        params={'n_reads': n_reads, 'p': p, 'seeds': seeds},
+        outputs={'reads_fasta': 'reads.fasta'},
+        modules=(utils,),
+        references=[os.path.join(utils.ref_data_folder, taxid + ".genomic.fna.gz") for taxid in refs['taxid']],
+        links={'reads_fasta': out})['reads_fasta']
+
+
+def cached_communities(species_list_fname: str, out_0: str = None, out_1: str = None) -> tuple:
+    """
+    Cached version of create_communities. The species files listed are part of the key
+    :param species_list_fname: the file listing one species per cluster
+    :param out_0: if given, community 0 is linked at this path
+    :param out_1: if given, community 1 is linked at this path
+    :return: paths to the cached communities
+    """
+    from utils import create_communities
+
+    with open(species_list_fname) as f:
+        references = [line.strip() for line in f if line.strip()]
+    cache = ArtifactCache()
+    paths = cache.run(
+        'create_communities', create_communities,
+        inputs={'species_list_fname': species_list_fname},
+        params={},
+        outputs={'community_0_fname': 'Comm_0.fasta', 'community_1_fname': 'Comm_1.fasta'},
+        references=references,
+        links={'community_0_fname': out_0, 'community_1_fname': out_1})
+    return paths['community_0_fname'], paths['community_1_fname']
+
+
+def cached_truncate_signal(input_filename: str, signal_length: int = 1600, out: str = None) -> str:
+    """
+    Cached version of truncate_signal
+    :param input_filename: the input blow5 file
+    :param signal_length: number of samples to keep
+    :param out: if given, the output is linked at this path
+    :return: path to the cached blow5
+    """
+    from utils import truncate_signal
+
+    cache = ArtifactCache()
+    return cache.run(
+        'truncate_signal', truncate_signal,
+        inputs={'input_filename': input_filename},
+        params={'signal_length': signal_length},
+        outputs={'output_filename': 'signals.blow5'},
+        links={'output_filename': out})['output_filename']
+
+
+def cached_basecall(blow5_in: str, config: str = "dna_r9.4.1_450bps_fast",
+                    address: str = "ipc:///tmp/.guppy/5555", out: str = None) -> str:
+    """
+    Cached version of basecall. The server address is not part of the key
+    :param blow5_in: the input blow5 file
+    :param config: the basecaller config
+    :param address: the basecall server address
+    :param out: if given, the output is linked at this path
+    :return: path to the cached fasta
+    """
+    from basecall import basecall
+
+    cache = ArtifactCache()
+    return cache.run(
+        'basecall', basecall,
+        inputs={'blow5_in': blow5_in},
+        params={'config': config},
+        outputs={'fasta_out': 'reads.fasta'},
+        settings={'address': address},
+        links={'fasta_out': out})['fasta_out']
+
+
+def evict_cache(quota: float = None):
+    """
+    Evict least recently used artifacts until the cache fits in the quota
+    :param quota: the quota in GB. Defaults to $NAS_CACHE_QUOTA or 100
+    :return: None
+    """
+    cache = ArtifactCache()
+    quota = cache.quota if quota is None else int(quota * (1 << 30))
+    n = cache.evict(quota)
+    info("Evicted {} artifacts. Cache size is {:.2f} GB".format(
+        n, sum(m['size'] for m in cache.manifests()) / (1 << 30)))
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Reconstruct per-chunk and per-read decision timelines from Readfish runs and report latency statistics.
+
+Inputs are the files written by a simulated run (see scripts/simulate_run.sh):
+    - readfish_*.log: the Readfish log. Every batch of chunks produces a line like
+      "0512R/0.2345s; Avg: 0498R/0.2210s; Seq:1,024; Unb:3,400; Pro:120; Slow batches (>0.40s): 3/812"
+    - <run_id>_readfish.tsv: the per-chunk debug log (client_iteration, read_in_loop, read_id, ..., timestamp)
+Plain or gzipped files are read line by line, so arbitrarily large logs can be profiled.
+"""
+import argparse
+import csv
+import gzip
+import math
+import os
+import re
+import sys
+from array import array
+from glob import glob
+
+BATCH_RE = re.compile(
+    r"(?P<size>\d+)R/(?P<time>[\d.]+)s; Avg: \d+R/[\d.]+s; "
+    r"Seq:(?P<seq>[\d,]+); Unb:(?P<unb>[\d,]+); Pro:(?P<pro>[\d,]+); "
+    r"Slow batches \(>(?P<deadline>[\d.]+)s\): (?P<slow>\d+)/(?P<total>\d+)")
+BREAK_READS_RE = re.compile(r"break_reads_after_seconds=(?P<deadline>[\d.]+)")
+
+PERCENTILES = (50, 90, 99)
+FINAL_DECISIONS = ('stop_receiving', 'unblock')
+
+
+def open_log(path: str):
+    """
+    Open a (possibly gzipped) log file for streaming
+    :param path: path to the log file
+    :return: a text file object
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, 'r', errors='replace')
+
+
+def percentile(sorted_values, q: float):
+    """
+    Percentile of a sorted sequence using linear interpolation between the closest ranks
+    :param sorted_values: the values, sorted in ascending order
+    :param q: percentile in [0, 100]
+    :return: the percentile, or nan if there are no values
+    """
+    if len(sorted_values) == 0:
+        return math.nan
+    k = (len(sorted_values) - 1) * q / 100.
+    lo = math.floor(k)
+    hi = math.ceil(k)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def parse_stage(spec: str) -> tuple:
+    """
+    Parse a stage specification of the form NAME=REGEX. The regex must have a named group 't' with the time
+    taken by the stage in seconds and may have a named group 'n' with the number of chunks processed.
+    :param spec: the stage specification
+    :return: a tuple (name, compiled regex)
+    """
+    name, _, pattern = spec.partition('=')
+    if not name or not pattern:
+        raise ValueError("Malformed stage '{}'. Expected NAME=REGEX".format(spec))
+    regex = re.compile(pattern)
+    if 't' not in regex.groupindex:
+        raise ValueError("Stage regex for '{}' must have a named group 't'".format(name))
+    return name, regex
+
+
+class RunProfile:
+    """
+    Accumulates the timeline of one run (or several runs, when merged).
+    Latencies are kept in compact arrays so that percentiles are exact.
+    """
+
+    def __init__(self, name: str, stages: list = ()):
+        self.name = name
+        self.stages = list(stages)
+        self.deadline = None
+        self.batch_sizes = array('l')
+        self.batch_times = array('d')
+        self.actions = {'seq': 0, 'unb': 0, 'pro': 0}
+        self.stage_times = {name: array('d') for name, _ in self.stages}
+        self.stage_sizes = {name: array('l') for name, _ in self.stages}
+        self.chunks_per_read = array('l')
+        self.read_times = array('d')
+        self.read_decisions = {}
+        self.n_chunks_logged = 0
+        # (first batch, end batch, deadline) of each merged run, as runs may have different deadlines
+        self.runs = None
+
+    def parse_log(self, path: str):
+        """
+        Stream a Readfish log and record batch sizes, batch latencies and any user defined stage timings
+        :param path: path to the Readfish log
+        :return: None
+        """
+        actions = {'seq': 0, 'unb': 0, 'pro': 0}
+        with open_log(path) as f_in:
+            for line in f_in:
+                m = BATCH_RE.search(line)
+                if m:
+                    self.batch_sizes.append(int(m['size']))
+                    self.batch_times.append(float(m['time']))
+                    # the action counts are cumulative, keep the last ones
+                    actions = {k: int(m[k].replace(',', '')) for k in actions}
+                    if self.deadline is None:
+                        self.deadline = float(m['deadline'])
+                    continue
+                m = BREAK_READS_RE.search(line)
+                if m:
+                    self.deadline = float(m['deadline'])
+                    continue
+                for name, regex in self.stages:
+                    m = regex.search(line)
+                    if m:
+                        self.stage_times[name].append(float(m['t']))
+                        if 'n' in regex.groupindex:
+                            self.stage_sizes[name].append(int(m['n']))
+                        break
+        for k in actions:
+            self.actions[k] += actions[k]
+
+    def parse_chunk_log(self, path: str):
+        """
+        Stream a Readfish debug log (one row per chunk) and reconstruct the timeline of each read: the number
+        of chunks seen and the time between the first chunk and the final decision. Reads are dropped from
+        memory as soon as a final decision (stop_receiving or unblock) is made for them.
+        :param path: path to the debug log
+        :return: None
+        """
+        open_reads = {}
+        with open_log(path) as f_in:
+            for row in csv.DictReader(f_in, delimiter='\t'):
+                try:
+                    read_key = (row['channel'], row['read_id'])
+                    timestamp = float(row['timestamp'])
+                    decision = row['decision']
+                except (KeyError, TypeError, ValueError):
+                    continue
+                self.n_chunks_logged += 1
+                first = open_reads.get(read_key)
+                if first is None:
+                    first = open_reads[read_key] = [timestamp, 0]
+                first[1] += 1
+                if decision in FINAL_DECISIONS:
+                    del open_reads[read_key]
+                    self.chunks_per_read.append(first[1])
+                    self.read_times.append(timestamp - first[0])
+                    self.read_decisions[decision] = self.read_decisions.get(decision, 0) + 1
+        # reads that were still being sequenced when the run stopped
+        self.read_decisions['undecided'] = self.read_decisions.get('undecided', 0) + len(open_reads)
+
+    def merge(self, other):
+        """
+        Add the timeline of another run to this one
+        :param other: another RunProfile with the same stages
+        :return: None
+        """
+        if self.runs is None:
+            self.runs = [r for r in self.batch_ranges() if r[1] > r[0]]
+        offset = len(self.batch_times)
+        self.runs.extend((start + offset, end + offset, deadline) for start, end, deadline in other.batch_ranges())
+        deadlines = set(r[2] for r in self.runs)
+        self.deadline = deadlines.pop() if len(deadlines) == 1 else None
+        self.batch_sizes.extend(other.batch_sizes)
+        self.batch_times.extend(other.batch_times)
+        for k, v in other.actions.items():
+            self.actions[k] += v
+        for name, _ in self.stages:
+            self.stage_times[name].extend(other.stage_times[name])
+            self.stage_sizes[name].extend(other.stage_sizes[name])
+        self.chunks_per_read.extend(other.chunks_per_read)
+        self.read_times.extend(other.read_times)
+        for k, v in other.read_decisions.items():
+            self.read_decisions[k] = self.read_decisions.get(k, 0) + v
+        self.n_chunks_logged += other.n_chunks_logged
+
+    def batch_ranges(self) -> list:
+        """
+        The batches of each run with the deadline of that run
+        :return: a list of (first batch, end batch, deadline) tuples
+        """
+        if self.runs is None:
+            return [(0, len(self.batch_times), self.deadline)]
+        return self.runs
+
+    def summary(self, deadline: float = None) -> dict:
+        """
+        Summarise the run
+        :param deadline: the chunk deadline in seconds. If None, the one found in the log of each run is used.
+        :return: a dict of statistics
+        """
+        row = {'run': self.name, 'deadline': self.deadline if deadline is None else deadline}
+        if row['deadline'] is None and self.runs:
+            # merged runs with different deadlines
+            row['deadline'] = math.nan
+
+        sizes = sorted(self.batch_sizes)
+        times = sorted(self.batch_times)
+        n_chunks = sum(sizes)
+        row['n_batches'] = len(times)
+        row['n_chunks'] = n_chunks
+        row['batch_size_mean'] = n_chunks / len(sizes) if sizes else math.nan
+        for q in PERCENTILES:
+            row['batch_size_p{}'.format(q)] = percentile(sizes, q)
+        row['batch_size_max'] = sizes[-1] if sizes else math.nan
+        for q in PERCENTILES:
+            row['batch_time_p{}'.format(q)] = percentile(times, q)
+        row['batch_time_max'] = times[-1] if times else math.nan
+
+        # every chunk in a batch is decided when the batch completes. Misses are counted per run, against
+        # the deadline of that run, over the runs whose deadline is known
+        n_batches, n_missed_batches, n_decisions, n_missed_decisions = 0, 0, 0, 0
+        for start, end, run_deadline in self.batch_ranges():
+            if deadline is not None:
+                run_deadline = deadline
+            if run_deadline is None:
+                continue
+            for i in range(start, end):
+                n_batches += 1
+                n_decisions += self.batch_sizes[i]
+                if self.batch_times[i] > run_deadline:
+                    n_missed_batches += 1
+                    n_missed_decisions += self.batch_sizes[i]
+        row['missed_batches_frac'] = n_missed_batches / n_batches if n_batches else math.nan
+        row['missed_decisions_frac'] = n_missed_decisions / n_decisions if n_decisions else math.nan
+        row.update(self.actions)
+
+        for name, _ in self.stages:
+            stage_times = sorted(self.stage_times[name])
+            row['{}_n'.format(name)] = len(stage_times)
+            for q in PERCENTILES:
+                row['{}_time_p{}'.format(name, q)] = percentile(stage_times, q)
+            if len(self.stage_sizes[name]):
+                row['{}_size_mean'.format(name)] = sum(self.stage_sizes[name]) / len(self.stage_sizes[name])
+
+        if self.n_chunks_logged:
+            chunks = sorted(self.chunks_per_read)
+            read_times = sorted(self.read_times)
+            row['n_reads'] = len(chunks)
+            for q in PERCENTILES:
+                row['chunks_per_read_p{}'.format(q)] = percentile(chunks, q)
+            for q in PERCENTILES:
+                row['read_decision_time_p{}'.format(q)] = percentile(read_times, q)
+            for decision in FINAL_DECISIONS + ('undecided',):
+                row['reads_{}'.format(decision)] = self.read_decisions.get(decision, 0)
+        return row
+
+
+# files of a run directory that are profiled: the Readfish logs written by simulate_run.sh and sweep.py,
+# and the Readfish debug log
+RUN_LOG_PATTERNS = ('readfish_*.log', 'readfish.log')
+RUN_CHUNK_LOG_PATTERNS = ('*_readfish.tsv',)
+
+
+def is_chunk_log(path: str) -> bool:
+    return path.endswith('.tsv') or path.endswith('.tsv.gz')
+
+
+def run_files(path: str) -> list:
+    """
+    Find the Readfish logs and debug logs (plain or gzipped) in a run directory
+    :param path: the run directory
+    :return: sorted list of paths
+    """
+    files = set()
+    for pattern in RUN_LOG_PATTERNS + RUN_CHUNK_LOG_PATTERNS:
+        for suffix in ('', '.gz'):
+            files.update(glob(os.path.join(path, '**', pattern + suffix), recursive=True))
+    return sorted(files)
+
+
+def profile_run(path: str, stages: list = ()) -> RunProfile:
+    """
+    Profile a single run. If path is a directory, the Readfish logs (readfish_*.log, readfish.log) and
+    debug logs (*_readfish.tsv) found under it are considered to belong to the same run. Other files, such
+    as server logs, are only parsed when given explicitly.
+    :param path: a log file, a debug log file or a run directory
+    :param stages: list of (name, regex) tuples for user defined stages
+    :return: the RunProfile of the run
+    """
+    if os.path.isdir(path):
+        name = os.path.basename(os.path.normpath(path))
+        files = run_files(path)
+    else:
+        name = os.path.basename(path)
+        files = [path]
+
+    profile = RunProfile(name, stages)
+    for f in files:
+        print("Parsing {} ...".format(f), file=sys.stderr)
+        if is_chunk_log(f):
+            profile.parse_chunk_log(f)
+        else:
+            profile.parse_log(f)
+    return profile
+
+
+def write_table(rows: list, out):
+    """
+    Write the summaries as a tab separated table. Columns missing in a row are left empty.
+    :param rows: list of dicts
+    :param out: file object to write to
+    :return: None
+    """
+    columns = []
+    for row in rows:
+        columns.extend(k for k in row if k not in columns)
+    writer = csv.DictWriter(out, fieldnames=columns, delimiter='\t', restval='', lineterminator='\n')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({k: ('{:.6g}'.format(v) if type(v) is float else v) for k, v in row.items()})
+
+
+def profile_logs(paths: list, out: str = None, deadline: float = None, stages: list = ()) -> list:
+    """
+    Profile several runs and write one row per run, followed by a row aggregating all of them
+    :param paths: list of log files or run directories
+    :param out: path to the output .tsv file. If None, the table is written to stdout
+    :param deadline: chunk deadline in seconds; overrides the one found in the logs
+    :param stages: list of NAME=REGEX user defined stages
+    :return: the list of summary rows
+    """
+    stages = [parse_stage(s) for s in stages]
+    total = RunProfile('ALL', stages)
+    rows = []
+    for path in paths:
+        profile = profile_run(path, stages)
+        rows.append(profile.summary(deadline))
+        total.merge(profile)
+    if len(paths) > 1:
+        rows.append(total.summary(deadline))
+
+    if out is None:
+        write_table(rows, sys.stdout)
+    else:
+        with open(out, 'w') as f_out:
+            write_table(rows, f_out)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-chunk decision latency profiler for Readfish runs.",
+        epilog="Examples:\n"
+               "  python %(prog)s logs/readfish_Oct10_101010.log\n"
+               "  python %(prog)s results/run_000 results/run_001 --out profile.tsv\n"
+               "  python %(prog)s run/ --stage 'map=mapped (?P<n>\\d+) reads in (?P<t>[\\d.]+)s'",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("paths", nargs="+",
+                        help="Readfish logs, debug logs (.tsv) or run directories. Files may be gzipped.")
+    parser.add_argument("--out", default=None, help="Output .tsv file (default: stdout).")
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="Chunk deadline in seconds (default: break_reads_after_seconds from the log).")
+    parser.add_argument("--stage", action="append", default=[], metavar="NAME=REGEX",
+                        help="A log line timing a stage. REGEX needs a named group 't' (seconds) and may\n"
+                             "have a named group 'n' (number of chunks). Can be repeated.")
+    args = parser.parse_args()
+
+    try:
+        profile_logs(args.paths, args.out, args.deadline, args.stage)
+    except BrokenPipeError:
+        # e.g. piped to head; do not complain again when stdout is flushed at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except (OSError, ValueError, re.error) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
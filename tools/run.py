@@ -1,36 +1,192 @@
 #!/usr/bin/env python
+from __future__ import annotations
+
 import argparse
+import ast
+import importlib
+import inspect
 import sys
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Command name -> module defining it. Modules are only imported when one of their commands is called,
+# so e.g. truncate_signal does not need the basecall client library. Dataframe arguments are read from
+# .tsv files and returned dataframes are written to the file given by --output (see read_dataframe).
+COMMANDS = {
+    # basecall.py
+    'basecall': 'basecall',
+    # utils.py
+    'load_library_report': 'utils',
+    'choose_species': 'utils',
+    'shuffle_ids': 'utils',
+    'sample_refs_for_read': 'utils',
+    'download_ref_files': 'utils',
+    'sample_reads': 'utils',
+    'generate_bacterial_sample': 'utils',
+    'split_human_gut_repr_refs': 'utils',
+    'select_species_from_clusters': 'utils',
+    'check_cluster_sanity': 'utils',
+    'get_file_sizes': 'utils',
+    'greedy_partition_files': 'utils',
+    'concatenate_files': 'utils',
+    'create_communities': 'utils',
+    'get_signal_count': 'utils',
+    'truncate_signal': 'utils',
+    'generate_reverse_complement_fasta': 'utils',
+    'generate_fwd_and_rev_fasta': 'utils',
+    'split_fasta': 'utils',
+    # pipeline.py
+    'cached_species': 'pipeline',
+    'cached_reads': 'pipeline',
+    'cached_communities': 'pipeline',
+    'cached_truncate_signal': 'pipeline',
+    'cached_basecall': 'pipeline',
+    'evict_cache': 'pipeline',
+}
+
+BOOL_VALUES = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
+
+
+def to_bool(value: str) -> bool:
+    if value.lower() not in BOOL_VALUES:
+        raise ValueError("expected one of {}".format(", ".join(BOOL_VALUES)))
+    return BOOL_VALUES[value.lower()]
+
+
+def to_literal(expected_type):
+    def convert(value: str):
+        result = ast.literal_eval(value)
+        if not isinstance(result, expected_type):
+            raise ValueError("expected a {}".format(expected_type.__name__))
+        return result
+    return convert
+
+
+def read_dataframe(path: str) -> pd.DataFrame:
+    """
+    Read a dataframe argument from a .tsv file, as written by --output (or by cached_species)
+    :param path: path to the .tsv file
+    :return: the dataframe
+    """
+    import pandas as pd
+
+    return pd.read_csv(path, delimiter="\t", index_col=0, dtype={'taxid': str})
+
+
+def is_dataframe(annotation) -> bool:
+    type_name = annotation if isinstance(annotation, str) else getattr(annotation, '__name__', str(annotation))
+    return type_name in ('pd.DataFrame', 'DataFrame')
+
+
+CONVERTERS = {
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': to_bool,
+    'list': to_literal(list),
+    'tuple': to_literal(tuple),
+    'dict': to_literal(dict),
+    'pd.DataFrame': read_dataframe,
+    'DataFrame': read_dataframe,
+}
+
+
+def convert_argument(param: inspect.Parameter, value: str):
+    """
+    Convert a command-line string to the type of the parameter. The type is taken from the annotation or,
+    if there is none, from the default value. Parameters with neither are passed as strings.
+    :param param: the parameter of the function being called
+    :param value: the string from the command line
+    :return: the converted value
+    """
+    if value == 'None' and param.default is None:
+        return None
+
+    annotation = param.annotation
+    if annotation is inspect.Parameter.empty:
+        if param.default is inspect.Parameter.empty:
+            return value
+        if param.default is None:
+            # untyped and optional: accept Python literals, otherwise keep the string
+            try:
+                return ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                return value
+        annotation = type(param.default)
+
+    # annotations may be strings when the module uses postponed evaluation
+    type_name = annotation if isinstance(annotation, str) else getattr(annotation, '__name__', str(annotation))
+    if type_name not in CONVERTERS:
+        raise ValueError("parameter of type '{}' cannot be passed from the command line".format(type_name))
+    return CONVERTERS[type_name](value)
+
+
+def load_command(name: str):
+    """
+    Import the module defining the command and return the function
+    :param name: the command name
+    :return: the function
+    """
+    module = importlib.import_module(COMMANDS[name])
+    return getattr(module, name)
 
-from basecall import basecall
-from utils import truncate_signal
 
 def main():
     """
     Parses command-line arguments and calls the specified function.
     """
     parser = argparse.ArgumentParser(
-        description="A script to dynamically call a function by name with positional and keyword arguments.",
-        epilog="Examples:\n"
-               "  python %(prog)s greet\n"
-               "  python %(prog)s say_hello World\n"
-               "  python %(prog)s add 10 20\n"
-               "  python %(prog)s profile Alice age=30\n"
-               "  python %(prog)s profile Bob age=25 city=Paris",
+        description="A script to call a pipeline function by name with positional and keyword arguments.\n"
+                    "Arguments are converted to the types of the function's parameters.",
+        epilog="Commands:\n  " + "\n  ".join(COMMANDS) + "\n\n"
+               "Examples:\n"
+               "  python %(prog)s truncate_signal in.blow5 out.blow5 signal_length=3200\n"
+               "  python %(prog)s split_fasta reads.fasta reads n_seq=5000\n"
+               "  python %(prog)s basecall in.blow5 out.fasta config=dna_r9.4.1_450bps_fast\n"
+               "  python %(prog)s load_library_report --output report.tsv\n"
+               "  python %(prog)s choose_species report.tsv 100 \"['bacteria']\" seed=1 --output species.tsv\n"
+               "  python %(prog)s download_ref_files species.tsv\n"
+               "  python %(prog)s truncate_signal --help",
         formatter_class=argparse.RawTextHelpFormatter
     )
 
     parser.add_argument("function_name", help="The name of the function to call.")
-    parser.add_argument("args", nargs="*", help="Arguments for the function. Use key=value for named arguments.")
+    parser.add_argument("args", nargs="*", help="Arguments for the function. Use key=value for named arguments.\n"
+                                                "Dataframe arguments are paths to .tsv files.")
+    parser.add_argument("-o", "--output", help="The .tsv file to write the dataframe returned by the function to.")
 
-    args = parser.parse_args()
+    # let '<function_name> --help' reach us instead of argparse
+    argv = sys.argv[1:]
+    show_help = len(argv) > 1 and argv[1] in ('-h', '--help')
+    if show_help:
+        argv = argv[:1]
+    args = parser.parse_intermixed_args(argv)
 
-    # Get the function from the global scope based on the provided name.
-    function_to_call = globals().get(args.function_name)
+    if args.function_name not in COMMANDS:
+        print(f"Error: Function '{args.function_name}' not found.")
+        sys.exit(1)
 
-    # Check if the name corresponds to a real, callable function.
-    if not (function_to_call and callable(function_to_call)):
-        print(f"Error: Function '{args.function_name}' not found or is not callable.")
+    try:
+        function_to_call = load_command(args.function_name)
+    except ImportError as e:
+        print(f"Error: Function '{args.function_name}' needs a module that could not be imported.")
+        print(f"Details: {e}")
+        sys.exit(1)
+    signature = inspect.signature(function_to_call)
+
+    if show_help:
+        print(f"{args.function_name}{signature}")
+        print(inspect.getdoc(function_to_call) or "")
+        sys.exit(0)
+
+    returns_dataframe = is_dataframe(signature.return_annotation)
+    if returns_dataframe and args.output is None:
+        print(f"Error: Function '{args.function_name}' returns a dataframe. Use --output to write it to a .tsv file.")
+        sys.exit(1)
+    if args.output is not None and not returns_dataframe:
+        print(f"Error: Function '{args.function_name}' does not return a dataframe, --output cannot be used.")
         sys.exit(1)
 
     # Separate positional and keyword arguments
@@ -38,30 +194,41 @@ def main():
     keyword_args = {}
     for arg in args.args:
         if "=" in arg:
-            try:
-                key, value = arg.split("=", 1)
-                # A simple check to ensure key is a valid identifier.
-                if not key.isidentifier():
-                     print(f"Error: Invalid keyword argument name: '{key}'")
-                     sys.exit(1)
-                keyword_args[key] = value
-            except ValueError:
-                # This should not happen with the split("=", 1) but is good practice.
-                print(f"Error: Malformed keyword argument '{arg}'. Expected format is key=value.")
+            key, value = arg.split("=", 1)
+            # A simple check to ensure key is a valid identifier.
+            if not key.isidentifier():
+                print(f"Error: Invalid keyword argument name: '{key}'")
                 sys.exit(1)
+            keyword_args[key] = value
         else:
             positional_args.append(arg)
 
     try:
-        # The '*' operator unpacks the list into positional arguments.
-        # The '**' operator unpacks the dictionary into keyword arguments.
-        function_to_call(*positional_args, **keyword_args)
+        bound = signature.bind(*positional_args, **keyword_args)
     except TypeError as e:
         # This catches mismatches in arguments.
         print(f"Error: Argument mismatch for function '{args.function_name}'.")
         print(f"Details: {e}")
         sys.exit(1)
 
+    for name, value in bound.arguments.items():
+        param = signature.parameters[name]
+        try:
+            if param.kind is inspect.Parameter.VAR_POSITIONAL:
+                bound.arguments[name] = tuple(value)
+            elif param.kind is not inspect.Parameter.VAR_KEYWORD:
+                bound.arguments[name] = convert_argument(param, value)
+        except (ValueError, SyntaxError, OSError) as e:
+            print(f"Error: Invalid value '{value}' for argument '{name}' of function '{args.function_name}'.")
+            print(f"Details: {e}")
+            sys.exit(1)
+
+    result = function_to_call(*bound.args, **bound.kwargs)
+    if returns_dataframe:
+        result.to_csv(args.output, sep="\t")
+    elif result is not None:
+        print(result)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
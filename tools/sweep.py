@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""
+Run a grid of simulated Readfish runs concurrently, each with its own simulator server, port and directory.
+
+The sweep is described by a TOML file, e.g.
+
+    outdir = "/scratch/NASExperiments/results/sweep_zymo"
+    certs = "/scratch/NASExperiments/code/MinknoApiSimulator/certs"
+    cpu_budget = 48
+
+    [grid]
+    config = ["configs/rf_mm_zymo.toml", "configs/rf_cl_zymo.toml"]
+    signals = [["/data/SimulatedDatasets/Zymo/signals/Sigs0_450.blow5",
+                "/data/SimulatedDatasets/Zymo/signals/Sigs1_450.blow5"]]
+    "regions.0.max_chunks" = [2, 4]
+    threads = [8, 16]
+
+Every key in [grid] other than 'config' (the base Readfish TOML), 'signals' (the inputs of the server),
+'threads' (the number of mapper threads, whatever the mapper calls that setting) and 'basecall_address' is a
+dotted path to a setting of the Readfish TOML. Integers index into lists and '*' matches every key at that level.
+Relative paths in 'config', 'signals' and 'certs' are relative to the sweep file.
+The results of all runs are collected into <outdir>/results.tsv.
+
+The basecall server is not started by the sweep. Unless 'basecall_address' is set (e.g. to a template such as
+"ipc:///tmp/.guppy/{port}", with one server started per address), every run uses the address of its base config,
+so concurrent runs share one basecall server and slow each other down. Its load is not part of the CPU budget.
+"""
+import argparse
+import itertools
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+from time import sleep, time
+
+import rtoml
+
+from profile_logs import profile_run, write_table
+from utils import info
+
+SERVER_CMD = "mksimserver --certs {certs} {inputs} --port {port}"
+CLIENT_CMD = ("readfish targets --wait-for-ready 5 --toml {toml} --port {port} --device {device} "
+              "--log-file {client_log} --experiment-name {name}")
+
+# the setting holding the number of threads, for each mapper plugin
+MAPPER_THREAD_KEYS = {
+    'mappy': 'n_threads',
+    'mappy_rs': 'n_threads',
+    'pycollinearity': 'n_threads',
+    'pyspumoni': 'threads',
+}
+SPECIAL_KEYS = ('config', 'signals', 'threads', 'basecall_address')
+
+DEFAULTS = {
+    'outdir': 'sweep',
+    'certs': '',
+    'device': 'MN12345',
+    'base_port': 50051,
+    'cpu_budget': os.cpu_count(),
+    'cpu_overhead': 2,
+    'startup_delay': 2.,
+    'server_cmd': SERVER_CMD,
+    'client_cmd': CLIENT_CMD,
+    'basecall_address': None,
+}
+
+
+def _set_path(conf, keys: list, value):
+    head, rest = keys[0], keys[1:]
+    if isinstance(conf, dict):
+        targets = list(conf.keys()) if head == '*' else [head]
+    elif isinstance(conf, list):
+        targets = list(range(len(conf))) if head == '*' else [int(head)]
+    else:
+        raise TypeError("not a table or a list")
+    if not targets:
+        raise KeyError(head)
+    for target in targets:
+        # only existing settings can be changed
+        current = conf[target]
+        if rest:
+            _set_path(current, rest, value)
+        else:
+            conf[target] = value
+
+
+def set_path(conf, path: str, value):
+    """
+    Set an existing value in a nested dict/list given a dotted path
+    :param conf: the parsed TOML
+    :param path: dotted path. Integers index into lists and '*' matches every key at that level
+    :param value: the value to set
+    :return: None
+    """
+    try:
+        _set_path(conf, path.split('.'), value)
+    except (KeyError, IndexError, TypeError, ValueError):
+        raise ValueError("'{}' is not a setting of the base config".format(path)) from None
+
+
+def mapper_thread_key(name: str, settings: dict) -> str:
+    """
+    The setting holding the number of threads of a mapper
+    :param name: the mapper plugin, as in [mapper_settings.<name>]
+    :param settings: the settings of the mapper
+    :return: the name of the setting
+    """
+    key = MAPPER_THREAD_KEYS.get(name)
+    if key is None:
+        keys = [k for k in set(MAPPER_THREAD_KEYS.values()) if k in settings]
+        if len(keys) != 1:
+            raise ValueError("Cannot tell the number of threads of mapper '{}'".format(name))
+        key = keys[0]
+    return key
+
+
+def set_threads(conf: dict, threads: int):
+    """
+    Set the number of threads of every mapper in the config
+    :param conf: the Readfish TOML of the run
+    :param threads: the number of threads
+    :return: None
+    """
+    for name, settings in conf.get('mapper_settings', {}).items():
+        settings[mapper_thread_key(name, settings)] = threads
+
+
+def cpu_cost(conf: dict, overhead: int) -> int:
+    """
+    Number of CPUs a run is expected to use: the mapper threads plus a fixed overhead for the server and client
+    :param conf: the Readfish TOML of the run
+    :param overhead: CPUs used by the server and the client besides the mapper
+    :return: the number of CPUs
+    """
+    threads = []
+    for name, settings in conf.get('mapper_settings', {}).items():
+        key = mapper_thread_key(name, settings)
+        if key not in settings:
+            raise ValueError("Mapper '{}' does not set '{}'".format(name, key))
+        threads.append(settings[key])
+    return max(threads, default=1) + overhead
+
+
+def set_basecall_address(conf: dict, address: str):
+    """
+    Set the address of the basecall server of every caller in the config
+    :param conf: the Readfish TOML of the run
+    :param address: the address of the basecall server
+    :return: None
+    """
+    callers = conf.get('caller_settings', {})
+    if not callers:
+        raise ValueError("The base config has no caller_settings to set the basecall address in")
+    for settings in callers.values():
+        settings['address'] = address
+
+
+def terminate(process: subprocess.Popen):
+    """Terminate a process, killing it if it does not stop within 30 seconds"""
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def expand_grid(grid: dict) -> list:
+    """
+    Cartesian product of the grid
+    :param grid: dict of parameter name to list of values
+    :return: a list of dicts, one per combination
+    """
+    keys = list(grid.keys())
+    for k in keys:
+        if type(grid[k]) is not list:
+            raise ValueError("Values of grid parameter '{}' must be a list".format(k))
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+class Run:
+    def __init__(self, index: int, params: dict, spec: dict):
+        self.index = index
+        self.params = params
+        self.name = "run_{:03d}".format(index)
+        self.dir = os.path.abspath(os.path.join(spec['outdir'], self.name))
+        self.port = spec['base_port'] + index
+        self.returncode = None
+        self.elapsed = None
+        self.processes = []
+        self.stopped = False
+        self.lock = threading.Lock()
+
+        with open(resolve(spec, params.get('config', spec.get('config', '')))) as f:
+            self.conf = rtoml.load(f)
+        for k, v in params.items():
+            if k not in SPECIAL_KEYS:
+                set_path(self.conf, k, v)
+        if 'threads' in params:
+            set_threads(self.conf, params['threads'])
+        self.cpus = cpu_cost(self.conf, spec['cpu_overhead'])
+
+        signals = params.get('signals', spec.get('signals', []))
+        fields = {
+            'certs': shlex.quote(resolve(spec, spec['certs'])),
+            'inputs': " ".join("--input {}".format(shlex.quote(resolve(spec, s))) for s in signals),
+            'port': self.port,
+            'device': shlex.quote(spec['device']),
+            'toml': shlex.quote(os.path.join(self.dir, 'readfish.toml')),
+            'client_log': shlex.quote(os.path.join(self.dir, 'readfish.log')),
+            'name': self.name,
+            'dir': shlex.quote(self.dir),
+        }
+        basecall_address = params.get('basecall_address', spec['basecall_address'])
+        if basecall_address:
+            set_basecall_address(self.conf, basecall_address.format(**fields))
+        self.server_cmd = spec['server_cmd'].format(**fields)
+        self.client_cmd = spec['client_cmd'].format(**fields)
+
+    def environment(self, certs: str) -> dict:
+        env = dict(os.environ)
+        env.update({
+            'PYTHONUNBUFFERED': '1',
+            'MINKNOW_API_USE_LOCAL_TOKEN': 'no',
+            'MINKNOW_SIMULATOR': 'true',
+            'MINKNOW_TRUSTED_CA': os.path.join(certs, 'server.pem'),
+            'MINKNOW_API_CLIENT_CERTIFICATE_CHAIN': os.path.join(certs, 'client.pem'),
+            'MINKNOW_API_CLIENT_KEY': os.path.join(certs, 'client.key'),
+            'TMPDIR': os.path.join(self.dir, 'tmp'),
+        })
+        return env
+
+    def start(self, cmd: str, out) -> subprocess.Popen:
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("stopped")
+            process = subprocess.Popen(shlex.split(cmd), cwd=self.dir, env=self.env,
+                                       stdout=out, stderr=subprocess.STDOUT)
+            self.processes.append(process)
+            return process
+
+    def stop(self):
+        """Terminate the server and client of the run, and do not start new ones"""
+        with self.lock:
+            self.stopped = True
+            processes = list(self.processes)
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+
+    def execute(self, spec: dict):
+        """
+        Start the server, run the client to completion and stop the server
+        :param spec: the sweep specification
+        :return: None
+        """
+        os.makedirs(os.path.join(self.dir, 'tmp'), exist_ok=True)
+        with open(os.path.join(self.dir, 'readfish.toml'), 'w') as f:
+            rtoml.dump(self.conf, f)
+        with open(os.path.join(self.dir, 'params.json'), 'w') as f:
+            json.dump(self.params, f, indent=2)
+
+        self.env = self.environment(resolve(spec, spec['certs']))
+        t0 = time()
+        with open(os.path.join(self.dir, 'server.log'), 'w') as server_log, \
+                open(os.path.join(self.dir, 'client.out'), 'w') as client_out:
+            try:
+                self.start(self.server_cmd, server_log)
+                sleep(spec['startup_delay'])
+                self.returncode = self.start(self.client_cmd, client_out).wait()
+            finally:
+                for process in reversed(self.processes):
+                    terminate(process)
+        self.elapsed = time() - t0
+
+    def result(self) -> dict:
+        row = {'run': self.name, 'port': self.port, 'cpus': self.cpus,
+               'returncode': self.returncode, 'elapsed': self.elapsed}
+        for k, v in self.params.items():
+            row[k] = " ".join(map(str, v)) if type(v) is list else v
+        summary = profile_run(self.dir).summary()
+        del summary['run']
+        row.update(summary)
+        return row
+
+
+def resolve(spec: dict, path: str) -> str:
+    """Resolve a path of the sweep file relative to the directory of the sweep file"""
+    if not path:
+        return path
+    return os.path.join(spec['base_dir'], os.path.expanduser(path))
+
+
+def sweep(spec_file: str, dry_run: bool = False) -> list:
+    """
+    Run all the combinations of the grid, as many at a time as the CPU budget allows
+    :param spec_file: path to the sweep TOML
+    :param dry_run: only print the commands that would be run
+    :return: the list of result rows
+    """
+    with open(spec_file) as f:
+        spec = rtoml.load(f)
+    for k, v in DEFAULTS.items():
+        spec.setdefault(k, v)
+    spec['base_dir'] = os.path.dirname(os.path.abspath(spec_file))
+
+    runs = [Run(i, params, spec) for i, params in enumerate(expand_grid(spec.get('grid', {})))]
+    info("{} runs, CPU budget {}".format(len(runs), spec['cpu_budget']))
+    if dry_run:
+        for run in runs:
+            print("# {} ({} CPUs) {}".format(run.name, run.cpus, json.dumps(run.params)))
+            print(run.server_cmd)
+            print(run.client_cmd)
+        return []
+
+    os.makedirs(spec['outdir'], exist_ok=True)
+    available = spec['cpu_budget']
+    cond = threading.Condition()
+
+    def worker(run, cpus):
+        nonlocal available
+        try:
+            run.execute(spec)
+            info("{} finished with code {} in {:.0f}s".format(run.name, run.returncode, run.elapsed))
+        except Exception as e:
+            info("{} failed: {}".format(run.name, e))
+        finally:
+            with cond:
+                available += cpus
+                cond.notify_all()
+
+    def handle_signal(signum, frame):
+        # like the cleanup trap of simulate_run.sh: do not leave servers running
+        info("Received signal {}, stopping all runs".format(signum))
+        for run in runs:
+            run.stop()
+        raise SystemExit(128 + signum)
+
+    handlers = {s: signal.signal(s, handle_signal) for s in (signal.SIGINT, signal.SIGTERM)}
+    threads = []
+    try:
+        for run in runs:
+            # a run larger than the whole budget is run on its own
+            cpus = min(run.cpus, spec['cpu_budget'])
+            with cond:
+                cond.wait_for(lambda: available >= cpus)
+                available -= cpus
+            info("Starting {} on port {} ({} CPUs)".format(run.name, run.port, cpus))
+            t = threading.Thread(target=worker, args=(run, cpus))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+    finally:
+        for s, handler in handlers.items():
+            signal.signal(s, handler)
+
+    rows = [run.result() for run in runs]
+    with open(os.path.join(spec['outdir'], 'results.tsv'), 'w') as f_out:
+        write_table(rows, f_out)
+    info("Results written to {}".format(os.path.join(spec['outdir'], 'results.tsv')))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a parameter sweep of simulated Readfish runs with isolated servers.",
+        epilog="Examples:\n"
+               "  python %(prog)s configs/sweep_zymo.toml --dry-run\n"
+               "  python %(prog)s configs/sweep_zymo.toml",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("spec", help="The sweep specification (.toml).")
+    parser.add_argument("--dry-run", action="store_true", help="Print the commands without running them.")
+    args = parser.parse_args()
+
+    try:
+        sweep(args.spec, args.dry_run)
+    except (ValueError, KeyError, OSError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
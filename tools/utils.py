@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import os
 # import re
 import urllib.request
@@ -6,17 +8,16 @@ from os import listdir, uname
 import random
 
 # import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
-import pyfastx
-from pyfastx import Fasta
-from tqdm import tqdm
-import pyfastx
 # from numba import jit, njit
-import pyslow5
 import argparse
 import sys
 from time import localtime, strftime
+from typing import TYPE_CHECKING
+
+# numpy, pandas, pyfastx, pyslow5 and tqdm are imported by the functions that use them, so that
+# calling one function (e.g. truncate_signal from run.py) does not pay for the imports of all the others
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def info(*args, **kwargs):
@@ -67,12 +68,17 @@ def __get_tax_id(x: str):
     return tokens[0][1:]
 
 
-def load_library_report():
+def load_library_report(path: str = None) -> pd.DataFrame:
     """
     Load KRAKEN library report into a dataframe and preprocess it
+    :param path: path to the library report. Defaults to lib_report_path
     :return: the dataframe containing the KRAKEN library report
     """
-    df = pd.read_csv(lib_report_path, delimiter="\t")
+    import pandas as pd
+
+    if path is None:
+        path = lib_report_path
+    df = pd.read_csv(path, delimiter="\t")
 
     df = df[df['#Library'] != 'UniVec_Core']
     df['taxid'] = None
@@ -98,6 +104,8 @@ def choose_species(df:pd.DataFrame, n_species: int, library: list, s=None, seed:
     :param seed: seed for random number if s is None (ignored is s is not None)
     :return: a dataframe slice with the chosen species
     """
+    import numpy as np
+
     df1 = df[df['#Library'].isin(library)]
     if s is None:
         # randomly choose the species
@@ -131,6 +139,8 @@ def shuffle_ids(df: pd.DataFrame, seed: int = None) -> list:
     :param seed: seed for numpy random generator
     :return: a shuffled list of the indices of the dataframe slice
     """
+    import numpy as np
+
     # get indexes and shuffle
     ids = df.index.to_list()
     np.random.default_rng(seed).shuffle(ids)
@@ -147,6 +157,9 @@ def sample_refs_for_read(shuffled_ids: list, n: int, p: float, seed=None) -> lis
     :param seed: seed used bu numpy random generator
     :return: a list of indices of the dataframe slice, from each of which exactly one read is to be drawn
     """
+    import numpy as np
+    from tqdm import tqdm
+
     rng = np.random.default_rng(seed)
     nr = len(shuffled_ids)
     read_ref_ids = [0] * n
@@ -205,10 +218,19 @@ def download_ref_files(df: pd.DataFrame, data_folder = None, start=0):
 class RefIdx:
     complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
 
-    def __init__(self, taxid: str):
+    def __init__(self, taxid: str, rng_pos=None, rng_seq=None):
+        """
+        :param taxid: taxonomy id of the reference
+        :param rng_pos: numpy random generator for read positions (unseeded if None)
+        :param rng_seq: numpy random generator for sequence and strand (unseeded if None)
+        """
+        import numpy as np
+        from pyfastx import Fasta
+
         self.taxid = taxid
         self.sequences = {}
-        self.rng = np.random.default_rng()
+        self.rng_pos = np.random.default_rng() if rng_pos is None else rng_pos
+        self.rng_seq = np.random.default_rng() if rng_seq is None else rng_seq
 
         filename = taxid + ".genomic.fna.gz"
         filepath = ref_data_folder + '/' + filename
@@ -218,15 +240,15 @@ class RefIdx:
         self.ids = list(self.sequences.keys())
 
     def get_sample_sequence(self, rdlen:int) -> tuple:
-        self.rng.shuffle(self.ids)
+        self.rng_seq.shuffle(self.ids)
         for id in self.ids:
             slen = len(self.sequences[id])
             if slen > rdlen:
                 # sample a read and return
                 end = slen - rdlen
-                startpos = self.rng.integers(end)
+                startpos = self.rng_pos.integers(end)
                 endpos = startpos + rdlen
-                complement = self.rng.choice(1)
+                complement = self.rng_seq.choice(1)
                 if not complement:
                     return id, self.sequences[id][startpos:endpos]
                 else:
@@ -249,6 +271,9 @@ def sample_reads(df: pd.DataFrame, read_refs: list, outfilepath: str,
         If the length of the list is less than 3, it's padded with Nones
     :return: None
     """
+    import numpy as np
+    from tqdm import tqdm
+
     if seeds is None:
         seeds = [None] * 3
     elif (type(seeds) is not list) or (not all(((type(x) == int) or (x is None)) for x in seeds)):
@@ -271,7 +296,7 @@ def sample_reads(df: pd.DataFrame, read_refs: list, outfilepath: str,
                 if curr_ref_id != sorted_refs[i]:
                     curr_ref_id = sorted_refs[i]
                     taxid = df.loc[curr_ref_id].taxid
-                    ref_idx = RefIdx(taxid)
+                    ref_idx = RefIdx(taxid, rng_pos=rng[1], rng_seq=rng[2])
 
                 retries = 10
                 while retries:
@@ -288,7 +313,7 @@ def sample_reads(df: pd.DataFrame, read_refs: list, outfilepath: str,
     return
 
 
-def generate_bacterial_sample(df:pd.DataFrame, outfile: str, n_reads, n_species: int = 100):
+def generate_bacterial_sample(df:pd.DataFrame, outfile: str, n_reads: int, n_species: int = 100):
     """
     Generate a set of reads from a bacterial community.
     :param df: Dataframe with Kraken library report
@@ -297,6 +322,8 @@ def generate_bacterial_sample(df:pd.DataFrame, outfile: str, n_reads, n_species:
     :param outfile: the output (fasta) file to write sequences to
     :return: None
     """
+    import numpy as np
+
     seeds = [1, 2, 3]
     p = 0.9
     dfs = choose_species(df, n_species, library=['bacteria'], seed=seeds[0])
@@ -317,6 +344,9 @@ def split_human_gut_repr_refs():
     into multiple files, one per representative species. There are 3594 representative species
     :return:
     """
+    import pyfastx
+    from tqdm import tqdm
+
     filename = '/scratch/HumanGut/Rep_all.fa'
     outdir = '/scratch/HumanGut/RefSplits/'
 
@@ -393,12 +423,12 @@ def check_cluster_sanity(species_list_fname):
         print("All OK!!")
 
 
-def get_file_sizes(file_list):
+def get_file_sizes(file_list: list):
     """Helper function to get sizes of files."""
     return [os.path.getsize(file.strip()) for file in file_list]
 
 
-def greedy_partition_files(file_list):
+def greedy_partition_files(file_list: list):
     """Partition files into two groups with roughly equal total sizes using a greedy heuristic."""
     file_sizes = get_file_sizes(file_list)
 
@@ -424,7 +454,9 @@ def greedy_partition_files(file_list):
     return group1, group2
 
 
-def concatenate_files(input_file_list, output_file):
+def concatenate_files(input_file_list: list, output_file):
+    import pyfastx
+
     n_species, n_sequences, n_bases = 0, 0, 0
     with open(output_file, 'w') as f_out:
         for filename in input_file_list:
@@ -458,6 +490,8 @@ def get_signal_count():
     Prints the number of reads in a slow5/blow5 file
     :return:
     """
+    import pyslow5
+    from tqdm import tqdm
 
     input_filename = '/scratch/HumanGut/blow5-180/signals_d0.1_Comm_1.blow5'
 
@@ -476,6 +510,7 @@ def truncate_signal(input_filename, output_filename, signal_length=1600):
     Take a blow5 file and create another one where the input signals are truncated to the specified length
     :return:
     """
+    import pyslow5
 
     # signal_length = 1600    # 1600 for .4s (~180 bp), 3200 for .8s (~360 bp)
     # input_filename = '/scratch/HumanGut/blow5-400/signals_d0.1_Comm_1.blow5'
@@ -506,6 +541,8 @@ def truncate_signal(input_filename, output_filename, signal_length=1600):
 
 
 def generate_reverse_complement_fasta(input_filename: str, output_filename: str):
+    import pyfastx
+
     assert input_filename != output_filename
     complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
     with open(output_filename, 'w') as f_out:
@@ -516,6 +553,8 @@ def generate_reverse_complement_fasta(input_filename: str, output_filename: str)
 
 
 def generate_fwd_and_rev_fasta(input_filename: str, output_filename: str):
+    import pyfastx
+
     assert input_filename != output_filename
     complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
     i = 0
@@ -530,6 +569,8 @@ def generate_fwd_and_rev_fasta(input_filename: str, output_filename: str):
 
 
 def split_fasta(input_filename: str, output_filebase: str, n_seq: int = 1000):
+    import pyfastx
+
     i, j = 0, 0
     f_out = None
     for name, seq in pyfastx.Fasta(input_filename, build_index=False, uppercase=True):